@@ -1,18 +1,25 @@
+import os
+import re
 import sys
 import asyncio
 import json
-from io import BytesIO
+from collections import Counter, OrderedDict
+from copy import deepcopy
 from urllib.parse import urlparse, urlunparse, urljoin
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures._base import TimeoutError
-from functools import partial
+from functools import partial, lru_cache
+from importlib import import_module
 from typing import Set, Union, List, MutableMapping, Optional, Mapping
 
 import requests
+from requests.adapters import HTTPAdapter
 from pyquery import PyQuery
 from fake_useragent import UserAgent
 import lxml
+import lxml.html
 from lxml import etree
+from lxml.cssselect import CSSSelector, SelectorError
 from parse import search as parse_search
 from parse import findall, Result
 from w3lib.encoding import html_to_unicode
@@ -22,6 +29,13 @@ DEFAULT_USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKi
 
 useragent = None
 
+# xmljson conversion conventions, imported on first use.
+_CONVERSIONS = ('badgerfish', 'abdera', 'cobra', 'gdata', 'parker', 'yahoo')
+_SERIALIZERS = {}
+
+# Trailing XPath steps which select attribute values or text nodes.
+_STRING_STEP = re.compile(r'/(@[\w.:*-]+|text\(\))\s*$')
+
 # Typing.
 _XPath = Union[List[str], List['Element'], str, 'Element']
 _Result = List['Result']
@@ -47,25 +61,156 @@ except AssertionError:
     raise RuntimeError('Requests-XML requires Python 3.6+!')
 
 
+@lru_cache(maxsize=512)
+def _compiled_xpath(selector: str) -> etree.XPath:
+    """Compiles an XPath selector once, re-using it on subsequent calls."""
+    return etree.XPath(selector)
+
+
+@lru_cache(maxsize=None)
+def _xml_parser(remove_blank_text: bool = False, huge_tree: bool = False) -> etree.XMLParser:
+    """Returns a shared XMLParser configured with the given options."""
+    return etree.XMLParser(remove_blank_text=remove_blank_text, huge_tree=huge_tree)
+
+
+@lru_cache(maxsize=512)
+def _selects_strings(selector: str) -> bool:
+    """Whether an XPath selector can only return strings, i.e. it ends in an
+    attribute (``/@href``) or text (``/text()``) step and is not a union.
+    """
+    return '|' not in selector and _STRING_STEP.search(selector) is not None
+
+
+@lru_cache(maxsize=256)
+def _compiled_css(selector: str, translator: str = 'xml') -> CSSSelector:
+    """Compiles a CSS selector once, re-using it on subsequent calls."""
+    return CSSSelector(selector, translator=translator)
+
+
+def _get_serializer(conversion: str):
+    """Returns the xmljson serializer for the given conversion convention."""
+    serializer = _SERIALIZERS.get(conversion)
+
+    if serializer is None:
+        if conversion not in _CONVERSIONS:
+            raise ValueError(f'Unknown JSON conversion: {conversion!r}')
+
+        serializer = getattr(import_module('xmljson'), conversion)
+        _SERIALIZERS[conversion] = serializer
+
+    return serializer
+
+
+def _badgerfish_value(value: str):
+    """Converts an XML string value to a boolean, int or float where it
+    looks like one, the same way xmljson does.
+    """
+    lowered = value.lower()
+    if lowered == 'true':
+        return True
+    if lowered == 'false':
+        return False
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+
+    # Infinity and NaN stay strings.
+    return number if float('-inf') < number < float('inf') else value
+
+
+def _badgerfish(root: _LXML) -> Mapping:
+    """Converts an lxml tree using the badgerfish convention; equivalent to
+    ``xmljson.badgerfish.data``, but walks the tree with a stack instead of
+    recursing once per element.
+    """
+    data = OrderedDict()
+    data[root.tag] = OrderedDict()
+    stack = [(root, data[root.tag])]
+
+    while stack:
+        element, value = stack.pop()
+
+        for attr, attrval in element.attrib.items():
+            value['@' + attr] = _badgerfish_value(attrval)
+
+        text = element.text
+        if text and text.strip():
+            value['$'] = _badgerfish_value(text)
+
+        # Skip comments and processing instructions.
+        children = [child for child in element if isinstance(child.tag, str)]
+        count = Counter(child.tag for child in children)
+
+        # Children are linked into their parent now and filled in once
+        # they are popped off the stack.
+        for child in children:
+            child_value = OrderedDict()
+
+            if count[child.tag] == 1:
+                value[child.tag] = child_value
+            else:
+                value.setdefault(child.tag, []).append(child_value)
+
+            stack.append((child, child_value))
+
+    return data
+
+
 class BaseParser:
     """A basic XML/Element Parser, for Humans.
 
     :param element: The element from which to base the parsing upon.
     :param default_encoding: Which encoding to default to.
     :param xml: XML from which to base the parsing upon (optional).
+    :param known_encoding: The encoding the XML is known to be in, skipping
+        detection (optional).
 
     """
 
-    def __init__(self, *, element, session: 'XMLSession' = None, default_encoding: _DefaultEncoding = DEFAULT_ENCODING, xml: _XML = None) -> None:
+    __slots__ = [
+        'element', '_session', 'default_encoding', '_encoding', '_xml',
+        '_lxml', '_lxml_error', '_pq', '_docinfo', '_json', '_raw_xml_cache',
+        '_xml_cache', '_parser'
+    ]
+
+    def __init__(self, *, element, session: 'XMLSession' = None, default_encoding: _DefaultEncoding = DEFAULT_ENCODING, xml: _XML = None, known_encoding: _Encoding = None) -> None:
         self.element = element
-        self.session = session or XMLSession()
+        self._session = session
         self.default_encoding = default_encoding
-        self._encoding = None
+        self._encoding = known_encoding
         self._xml = xml.encode(DEFAULT_ENCODING) if isinstance(xml, str) else xml
         self._lxml = None
+        self._lxml_error = None
         self._pq = None
         self._docinfo = None
-        self._json = None
+        self._json = {}
+        self._raw_xml_cache = None
+        self._xml_cache = None
+        self._parser = None
+
+
+    @property
+    def session(self) -> 'XMLSession':
+        """The :class:`XMLSession <XMLSession>` belonging to this parser,
+        created on first access.
+        """
+        if self._session is None:
+            self._session = XMLSession()
+
+        return self._session
+
+
+    @session.setter
+    def session(self, session: 'XMLSession') -> None:
+        """Property setter for self.session."""
+        self._session = session
 
 
     @property
@@ -73,10 +218,13 @@ class BaseParser:
         """Bytes representation of the XML content.
         (`learn more <http://www.diveintopython3.net/strings.html>`_).
         """
-        if self._xml:
+        if self._xml is not None:
             return self._xml
-        else:
-            return etree.tostring(self.element, encoding='unicode').strip().encode(self.encoding)
+
+        if self._raw_xml_cache is None:
+            self._raw_xml_cache = self.xml.encode(self.encoding)
+
+        return self._raw_xml_cache
 
 
     @property
@@ -84,27 +232,47 @@ class BaseParser:
         """Unicode representation of the XML content
         (`learn more <http://www.diveintopython3.net/strings.html>`_).
         """
-        if self._xml:
-            return self.raw_xml.decode(self.encoding)
-        else:
-            return etree.tostring(self.element, encoding='unicode').strip()
+        if self._xml_cache is None:
+            if self._xml is not None:
+                self._xml_cache = self._xml.decode(self.encoding)
+            else:
+                # Serialize the element once; raw_xml is encoded from this as well.
+                self._xml_cache = etree.tostring(self.element, encoding='unicode').strip()
+
+        return self._xml_cache
 
 
     @xml.setter
     def xml(self, xml: str) -> None:
-        self._xml = xml.encode(self.encoding)
+        self.raw_xml = xml.encode(self.encoding)
+        self._xml_cache = xml
 
 
     @raw_xml.setter
     def raw_xml(self, xml: bytes) -> None:
         """Property setter for self.html."""
         self._xml = xml
+        self._raw_xml_cache = None
+        self._xml_cache = None
+
+        # Anything derived from the old document is stale now.
+        self._lxml = None
+        self._lxml_error = None
+        self._pq = None
+        self._docinfo = None
+        self._json = {}
 
 
     @property
     def pq(self) -> PyQuery:
         """`PyQuery <https://pythonhosted.org/pyquery/>`_ representation
         of the :class:`Element <Element>` or :class:`HTML <HTML>`.
+
+        PyQuery parses its own copy of the document, falling back to HTML
+        when it isn't well-formed XML, so changes made through it aren't
+        seen by :attr:`lxml` or :meth:`xpath`.  They are seen by
+        :meth:`find` for jQuery-style selectors, and for documents that
+        aren't well-formed XML, as both are queried through PyQuery.
         """
         if self._pq is None:
             self._pq = PyQuery(self.raw_xml)
@@ -116,8 +284,26 @@ class BaseParser:
         """`lxml <http://lxml.de>`_ representation of the
         :class:`Element <Element>` or :class:`XML <XML>`.
         """
+        # A document that failed to parse raises the same error again,
+        # rather than being re-parsed on every access.
+        if self._lxml_error is not None:
+            raise self._lxml_error.with_traceback(None)
+
         if self._lxml is None:
-            self._lxml = etree.fromstring(self.raw_xml)
+            if self._xml is None and isinstance(self.element, etree._Element):
+                # A document root can be used as-is; anything else is
+                # detached into its own document so that absolute selectors
+                # stay scoped to this element.
+                if self.element.getroottree().getroot() is self.element:
+                    self._lxml = self.element
+                else:
+                    self._lxml = deepcopy(self.element)
+            else:
+                try:
+                    self._lxml = etree.fromstring(self.raw_xml, self._parser or _xml_parser())
+                except etree.XMLSyntaxError as error:
+                    self._lxml_error = error
+                    raise
 
         return self._lxml
 
@@ -132,13 +318,13 @@ class BaseParser:
     @property
     def links(self) -> _Links:
         """All found links on page, in as–is form.  Only works for Atom feeds."""
-        return list(set(x.text for x in self.xpath('//link')))
+        return list({link.text for link in self.lxml.iter('link') if link.text})
 
 
     @property
     def docinfo(self) -> etree.DocInfo:
         if self._docinfo is None:
-            self._docinfo = etree.parse(BytesIO(self.raw_xml)).docinfo
+            self._docinfo = self.lxml.getroottree().docinfo
 
         return self._docinfo
 
@@ -161,9 +347,9 @@ class BaseParser:
         if self._encoding:
             return self._encoding
 
-        # Scan meta tags for charset.
+        # Scan meta tags for charset; any declaration must be in the first few KB.
         if self._xml:
-            self._encoding = html_to_unicode(self.default_encoding, self._xml)[0]
+            self._encoding = html_to_unicode(self.default_encoding, self._xml[:4096])[0]
 
         return self._encoding if self._encoding else self.default_encoding
 
@@ -172,35 +358,23 @@ class BaseParser:
     def encoding(self, enc: str) -> None:
         """Property setter for self.encoding."""
         self._encoding = enc
+        self._raw_xml_cache = None
+        self._xml_cache = None
 
 
     def json(self, conversion: _Text = 'badgerfish') -> Mapping:
         """A JSON Representation of the XML.  Default is badgerfish.
         :param conversion: Which conversion method to use. (`learn more <https://github.com/sanand0/xmljson#conventions>`_)
         """
-        if not self._json:
-
-            if conversion is 'badgerfish':
-                from xmljson import badgerfish as serializer
-
-            elif conversion is 'abdera':
-                from xmljson import abdera as serializer
-
-            elif conversion is 'cobra':
-                from xmljson import cobra as serializer
+        if conversion not in self._json:
+            if conversion == 'badgerfish':
+                data = _badgerfish(self.lxml)
+            else:
+                data = _get_serializer(conversion).data(self.lxml)
 
-            elif conversion is 'gdata':
-                from xmljson import gdata as serializer
+            self._json[conversion] = json.dumps(data)
 
-            elif conversion is 'parker':
-                from xmljson import parker as serializer
-
-            elif conversion is 'yahoo':
-                from xmljson import yahoo as serializer
-
-            self._json = json.dumps(serializer.data(etree.fromstring(self.xml)))
-
-        return self._json
+        return self._json[conversion]
 
 
     def xpath(self, selector: str, *, first: bool = False, _encoding: str = None) -> _XPath:
@@ -221,13 +395,17 @@ class BaseParser:
         If ``first`` is ``True``, only returns the first
         :class:`Element <Element>` found.
         """
-        selected = self.lxml.xpath(selector)
+        selected = _compiled_xpath(selector)(self.lxml)
 
-        elements = [
-            Element(element=selection, default_encoding=_encoding or self.encoding)
-            if not isinstance(selection, etree._ElementUnicodeResult) else str(selection)
-            for selection in selected
-        ]
+        if _selects_strings(selector):
+            elements = list(map(str, selected))
+        else:
+            encoding = _encoding or self.encoding
+            elements = [
+                Element(element=selection, default_encoding=encoding)
+                if not isinstance(selection, etree._ElementUnicodeResult) else str(selection)
+                for selection in selected
+            ]
 
         return _get_first_or_list(elements, first)
 
@@ -260,21 +438,47 @@ class BaseParser:
             if isinstance(containing, str):
                 containing = [containing]
 
+            # Documents that aren't well-formed XML go straight to PyQuery,
+            # which falls back to parsing them as HTML.
+            root = None
+            if self._lxml_error is None:
+                try:
+                    root = self.lxml
+                except etree.XMLSyntaxError:
+                    pass
+
+            # Plain CSS is compiled and cached; jQuery extensions such as
+            # ``:first`` or ``:eq(n)`` are left to PyQuery.  HTML trees have
+            # lowercased tags, so they're matched case-insensitively.
+            if root is None:
+                selected = self.pq(selector)
+            else:
+                translator = 'html' if isinstance(root, lxml.html.HtmlElement) else 'xml'
+                try:
+                    selected = _compiled_css(selector, translator)(root)
+                except SelectorError:
+                    selected = self.pq(selector)
+
             encoding = _encoding or self.encoding
             elements = [
                 Element(element=found, default_encoding=encoding)
-                for found in self.pq(selector)
+                for found in selected
             ]
 
             if containing:
-                elements_copy = elements.copy()
-                elements = []
+                needles = [c.lower() for c in containing]
+
+                # Many needles are cheaper to look for in a single scan.
+                if len(needles) > 4:
+                    pattern = re.compile('|'.join(re.escape(needle) for needle in needles))
 
-                for element in elements_copy:
-                    if any([c.lower() in element.text.lower() for c in containing]):
-                        elements.append(element)
+                    def matches(text):
+                        return pattern.search(text) is not None
+                else:
+                    def matches(text):
+                        return any(needle in text for needle in needles)
 
-                elements.reverse()
+                elements = [element for element in elements if matches(element.text.lower())]
 
             return _get_first_or_list(elements, first)
 
@@ -292,10 +496,7 @@ class Element(BaseParser):
     :param default_encoding: Which encoding to default to.
     """
 
-    __slots__ = [
-        'element', 'default_encoding', '_encoding',
-        '_xml', '_lxml', '_pq', '_attrs', 'session'
-    ]
+    __slots__ = ['_attrs']
 
     def __init__(self, *, element, default_encoding: _DefaultEncoding = None) -> None:
         super(Element, self).__init__(element=element, default_encoding=default_encoding)
@@ -312,12 +513,15 @@ class Element(BaseParser):
         (`learn more <https://www.w3schools.com/tags/ref_attributes.asp>`_).
         """
         if self._attrs is None:
-            self._attrs = {k: v for k, v in self.element.items()}
+            attrs = dict(self.element.attrib)
 
             # Split class and rel up, as there are ussually many of them:
-            for attr in ['class', 'rel']:
-                if attr in self._attrs:
-                    self._attrs[attr] = tuple(self._attrs[attr].split())
+            for attr in ('class', 'rel'):
+                value = attrs.get(attr)
+                if value is not None:
+                    attrs[attr] = tuple(value.split())
+
+            self._attrs = attrs
 
         return self._attrs
 
@@ -327,24 +531,54 @@ class XML(BaseParser):
 
     :param xml: XML from which to base the parsing upon (optional).
     :param default_encoding: Which encoding to default to.
+    :param remove_blank_text: Whether to drop whitespace-only text between
+        elements while parsing, for a smaller tree.
+    :param huge_tree: Whether to lift libxml2's limits on tree depth and
+        text size, for very large documents.  Only use with trusted input.
     """
 
-    def __init__(self, *, xml: _XML, default_encoding: str = DEFAULT_ENCODING) -> None:
+    __slots__ = []
 
-        # Convert incoming unicode HTML into bytes.
+    def __init__(self, *, xml: _XML, default_encoding: str = DEFAULT_ENCODING,
+                 remove_blank_text: bool = False, huge_tree: bool = False) -> None:
+
+        # Convert incoming unicode HTML into bytes, in an encoding we then know.
+        known_encoding = None
         if isinstance(xml, str):
             xml = xml.encode(DEFAULT_ENCODING)
+            known_encoding = DEFAULT_ENCODING
 
         super(XML, self).__init__(
-            # Convert unicode HTML to bytes.
-            element=PyQuery(xml)('xml') or PyQuery(f'<xml>{xml}</xml>')('xml'),
+            element=None,
             xml=xml,
-            default_encoding=default_encoding
+            default_encoding=default_encoding,
+            known_encoding=known_encoding
         )
 
+        # Re-parse with the same options after the xml/raw_xml setters.
+        self._parser = _xml_parser(remove_blank_text, huge_tree)
+        self._parse_element()
+
     def __repr__(self) -> str:
         return f"<XML element={self.element!r}>"
 
+    @BaseParser.raw_xml.setter
+    def raw_xml(self, xml: bytes) -> None:
+        """Property setter for self.raw_xml, re-parsing the element."""
+        BaseParser.raw_xml.fset(self, xml)
+        self._parse_element()
+
+    def _parse_element(self) -> None:
+        """Parses the document's root element.  A document that isn't
+        well-formed XML gets PyQuery's lenient HTML parse instead, while
+        :attr:`lxml` and :meth:`xpath` raise ``XMLSyntaxError`` for it.
+        """
+        try:
+            self.element = self.lxml
+        except etree.XMLSyntaxError:
+            # Empty and whitespace-only documents have no element at all.
+            self.element = self.pq[0] if len(self.pq) else None
+
 
 class XMLResponse(requests.Response):
     """An XML-enabled :class:`requests.Response <requests.Response>` object.
@@ -373,7 +607,10 @@ class XMLResponse(requests.Response):
 
 def user_agent(style=None) -> _UserAgent:
     """Returns an apparently legit user-agent, if not requested one of a specific
-    style. Defaults to a Chrome-style User-Agent.
+    style. Defaults to a Safari-style User-Agent.
+
+    `fake-useragent <https://github.com/hellysmile/fake-useragent>`_ is only
+    loaded by the first call that asks for a style.
     """
     global useragent
     if (not useragent) and style:
@@ -429,14 +666,19 @@ class XMLSession(requests.Session):
 class AsyncXMLSession(requests.Session):
     """ An async consumable session. """
 
+    # The blocking request method, looked up once rather than through a
+    # super() proxy on every call.
+    _super_request = requests.Session.request
+
     def __init__(self, loop=None, workers=None,
                  mock_browser: bool = True, *args, **kwargs):
         """ Set or create an event loop and a thread pool.
 
             :param loop: Asyncio lopp to use.
             :param workers: Amount of threads to use for executing async calls.
-                If not pass it will default to the number of processors on the
-                machine, multiplied by 5. """
+                If not passed it will default to ThreadPoolExecutor's: the
+                number of processors on the machine multiplied by 5, or on
+                Python 3.8+ plus 4 and capped at 32. """
         super().__init__(*args, **kwargs)
 
         # Mock a web browser's user agent.
@@ -445,9 +687,21 @@ class AsyncXMLSession(requests.Session):
 
         self.hooks["response"].append(self.response_hook)
 
+        # Same default as ThreadPoolExecutor on the running Python.
+        if not workers:
+            if sys.version_info >= (3, 8):
+                workers = min(32, (os.cpu_count() or 1) + 4)
+            else:
+                workers = (os.cpu_count() or 1) * 5
+
         self.loop = loop or asyncio.get_event_loop()
         self.thread_pool = ThreadPoolExecutor(max_workers=workers)
 
+        # Give every worker thread its own pooled connection, rather than
+        # having them queue up behind requests' default pool of 10.
+        for prefix in ('http://', 'https://'):
+            self.mount(prefix, HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+
     @staticmethod
     def response_hook(response, **kwargs) -> XMLResponse:
         """ Change response enconding and replace it by a HTMLResponse. """
@@ -455,6 +709,12 @@ class AsyncXMLSession(requests.Session):
         return XMLResponse._from_response(response)
 
     def request(self, *args, **kwargs):
-        """ Partial original request func and run it in a thread. """
-        func = partial(super().request, *args, **kwargs)
+        """ Run the original request func in a thread. """
+        func = partial(self._super_request, *args, **kwargs)
         return self.loop.run_in_executor(self.thread_pool, func)
+
+    def close(self):
+        """ Wait for in-flight requests, then shut down the thread pool
+            and close the session's adapters. """
+        self.thread_pool.shutdown()
+        super().close()
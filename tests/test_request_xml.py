@@ -1,9 +1,14 @@
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import pytest
+from lxml import etree
 
-from requests_xml import XMLSession, AsyncXMLSession, XML
+import requests_xml
+from requests_xml import XMLSession, AsyncXMLSession, XML, user_agent, DEFAULT_USER_AGENT
+from fake_useragent import FakeUserAgentError
 from requests_file import FileAdapter
 
 session = XMLSession()
@@ -42,6 +47,40 @@ async def test_async_file_get(async_get):
     assert r.status_code == 200
 
 
+@pytest.mark.ok
+def test_user_agent(monkeypatch):
+    assert user_agent() == DEFAULT_USER_AGENT
+
+    # fake-useragent may fetch its data over the network; stub it out.
+    # A failed load is retried by the next styled call.
+    def unavailable():
+        raise FakeUserAgentError('no data')
+
+    monkeypatch.setattr(requests_xml, 'useragent', None)
+    monkeypatch.setattr(requests_xml, 'UserAgent', unavailable)
+    with pytest.raises(FakeUserAgentError):
+        user_agent('firefox')
+
+    monkeypatch.setattr(requests_xml, 'UserAgent', lambda: {'firefox': 'Firefox'})
+    assert user_agent('firefox') == 'Firefox'
+
+
+@pytest.mark.ok
+def test_async_close(event_loop):
+    with AsyncXMLSession(loop=event_loop) as async_session:
+        pass
+
+    with pytest.raises(RuntimeError):
+        async_session.thread_pool.submit(print)
+
+
+@pytest.mark.ok
+def test_async_workers(event_loop):
+    # The default matches the running Python's ThreadPoolExecutor.
+    with AsyncXMLSession(loop=event_loop) as async_session:
+        assert async_session.thread_pool._max_workers == ThreadPoolExecutor()._max_workers
+
+
 @pytest.mark.ok
 def test_attrs():
     r = get()
@@ -82,11 +121,41 @@ def test_xpath():
     items = r.xml.xpath('//item')
     assert len(items) == 60
 
+    urls = r.xml.xpath('//enclosure/@url')
+    assert len(urls) == 60
+    assert all(type(url) is str for url in urls)
+
+@pytest.mark.ok
+def test_element_xpath():
+    r = get()
+    item = r.xml.xpath('//item', first=True)
+
+    titles = item.xpath('//title')
+    assert len(titles) == 1
+    assert titles[0].text == 'The Beauty of Light'
+
+@pytest.mark.ok
+def test_docinfo():
+    r = get()
+    assert r.xml.xml_version == '1.0'
+    assert r.xml.root_tag == 'rss'
+
+    item = r.xml.xpath('//item', first=True)
+    assert item.root_tag == 'item'
+
 @pytest.mark.ok
 def test_find():
     r = get()
     title_the = r.xml.find('title', containing='The')
     assert len(title_the) == 25
+    assert title_the[0].text == 'NASA Image of the Day'
+
+    title_many = r.xml.find('title', containing=['The', 'THE', 'tHe', 'thE', 'the.'])
+    assert len(title_many) == 25
+
+    # jQuery-style pseudo-classes are handled by PyQuery.
+    assert r.xml.find('title:first', first=True).text == 'NASA Image of the Day'
+    assert r.xml.find('item:eq(1) > title', first=True).text == 'Space Station Bound!'
 
 
 @pytest.mark.ok
@@ -108,6 +177,122 @@ def test_XML_loading():
     assert isinstance(xml.raw_xml, bytes)
     assert isinstance(xml.xml, str)
 
+    compact = XML(xml=doc, remove_blank_text=True)
+    assert compact.lxml.text is None
+    assert compact.links == xml.links
+
+    # Parsing options are kept when the document is replaced.
+    compact.xml = doc
+    assert compact.lxml.text is None
+
+
+@pytest.mark.ok
+def test_XML_huge_tree():
+    # Deeper than libxml2 allows without huge_tree.
+    doc = '<a>' * 300 + '</a>' * 300
+
+    xml = XML(xml=doc, huge_tree=True)
+    assert xml.root_tag == 'a'
+    assert len(xml.xpath('//a')) == 300
+
+    xml.xml = doc
+    assert xml.root_tag == 'a'
+    assert len(xml.xpath('//a')) == 300
+
+
+@pytest.mark.ok
+def test_json():
+    r = get()
+    badgerfish = json.loads(r.xml.json())
+    assert badgerfish['rss']['@version'] == 2.0
+
+    from xmljson import badgerfish as serializer
+    assert r.xml.json() == json.dumps(serializer.data(r.xml.lxml))
+
+    doc = """<a><b>1</b><b>2</b></a>"""
+    xml = XML(xml=doc)
+    assert json.loads(xml.json('parker')) == {'b': [1, 2]}
+
+    with pytest.raises(ValueError):
+        xml.json('unknown')
+
+
+@pytest.mark.ok
+def test_XML_malformed():
+    # Documents that aren't well-formed XML are parsed leniently as HTML
+    # for find() and text, while xpath() and json() raise.
+    xml = XML(xml=b'<html><body><p>Not found<br></body></html>')
+    assert isinstance(xml.element, etree._Element)
+    assert [p.text for p in xml.find('p')] == ['Not found']
+    assert xml.text == 'Not found'
+    assert xml.search('<p>{}<br>')[0][0] == 'Not found'
+    with pytest.raises(etree.XMLSyntaxError):
+        xml.xpath('//p')
+
+    fragments = XML(xml='<a>x</a><b>y</b>')
+    assert fragments.xml == '<a>x</a><b>y</b>'
+    assert [b.text for b in fragments.find('b')] == ['y']
+
+    # An RSS feed that is only malformed by an HTML entity.
+    feed = XML(xml=b"""<rss xmlns:atom="http://www.w3.org/2005/Atom"><channel>
+        <managingEditor>Editor&nbsp;Name</managingEditor>
+    </channel></rss>""")
+    with pytest.raises(etree.XMLSyntaxError):
+        feed.xpath('//managingEditor')
+    with pytest.raises(etree.XMLSyntaxError):
+        feed.json()
+    with pytest.raises(etree.XMLSyntaxError):
+        feed.root_tag
+
+    assert 'Editor' in feed.find('managingEditor', first=True).text
+
+    # The failed parse is remembered rather than repeated.
+    error = feed._lxml_error
+    with pytest.raises(etree.XMLSyntaxError):
+        feed.lxml
+    assert feed._lxml_error is error
+    channel = feed.find('channel', first=True)
+    assert 'Editor' in channel.find('managingEditor', first=True).text
+
+
+@pytest.mark.ok
+def test_XML_empty():
+    # Such as the body of a 204 response or a HEAD request.
+    for doc in (b'', b'  \n'):
+        xml = XML(xml=doc)
+        assert xml.element is None
+        assert xml.raw_xml == doc
+        assert xml.find('a') == []
+        assert xml.text == ''
+
+
+@pytest.mark.ok
+def test_XML_setters():
+    xml = XML(xml='<a><b>1</b></a>')
+    assert xml.xpath('//b', first=True).text == '1'
+
+    xml.xml = '<d/>'
+    assert xml.element.tag == 'd'
+    assert repr(xml).startswith('<XML element=<Element d ')
+
+    xml.xml = '<a><c>2</c></a>'
+    assert xml.xml == '<a><c>2</c></a>'
+    assert xml.xpath('//b') == []
+    assert xml.xpath('//c', first=True).text == '2'
+    assert json.loads(xml.json('parker')) == {'c': 2}
+
+    xml.raw_xml = b'<d><e>3</e></d>'
+    assert xml.raw_xml == b'<d><e>3</e></d>'
+    assert xml.xml == '<d><e>3</e></d>'
+    assert [e.text for e in xml.find('e')] == ['3']
+    assert xml.root_tag == 'd'
+    assert xml.element.tag == 'd'
+    assert xml.text == '3'
+
+    # PyQuery works on its own copy of the document.
+    xml.pq('e').remove()
+    assert len(xml.xpath('//e')) == 1
+
 
 @pytest.mark.ok
 def test_XML_XSLT():